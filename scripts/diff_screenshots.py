@@ -2,7 +2,7 @@
 """Diff explore vs script screenshots and write diff images + report.
 
 Usage:
-  python3 scripts/diff_screenshots.py [run_folder]
+  python3 scripts/diff_screenshots.py [--cache-npy] [run_folder]
 
 run_folder is a timestamped directory under screenshots/ with this layout:
 
@@ -13,13 +13,28 @@ run_folder is a timestamped directory under screenshots/ with this layout:
     └── report.md     <- generated report
 
 Defaults to the latest timestamped folder in screenshots/.
+
+--cache-npy keeps a raw pixel copy next to each screenshot
+(NN-name.<digest>.npy, keyed by the PNG's content) and memory-maps it on
+later runs instead of decoding the PNG again. Only re-running the same
+folder benefits, and unchanged pairs are already skipped via
+diff/.cache.json; what it saves is decoding the untouched side of a pair
+whose other screenshot was replaced in place. Each sidecar is uncompressed
+(width x height x 3 bytes), written into explore/ and script/.
 """
 
+import argparse
+import hashlib
+import json
 import math
-import sys
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 from pathlib import Path
 
-from PIL import Image, ImageChops, ImageStat
+import numpy as np
+from PIL import Image
 
 ROOT = Path(__file__).resolve().parents[1]
 SHOTS_ROOT = ROOT / "screenshots"
@@ -29,35 +44,181 @@ SHOTS_ROOT = ROOT / "screenshots"
 # against local Chromium (pytest-playwright scripts). Font smoothing,
 # sub-pixel rendering, and emoji rendering cause RMS ~11-21 even when
 # the page content is identical. Real content differences start at ~30+.
+# They assume RMS over the full-resolution diff: downsampling first
+# averages away sub-pixel noise and shifts every value down.
 MATCH_THRESHOLD = 22.0   # below this = rendering noise
 REVIEW_THRESHOLD = 30.0  # below this = minor diff; at or above = major diff
 
+# Squares of every possible uint8 channel difference, for histogram RMS.
+SQ = np.arange(256, dtype=np.int64) ** 2
 
-def rms(stat):
-    if isinstance(stat, (list, tuple)):
-        return math.sqrt(sum(v * v for v in stat) / len(stat))
-    return stat
-
-
-def load_image(path: Path) -> Image.Image:
-    img = Image.open(path)
-    if img.mode != "RGB":
-        img = img.convert("RGB")
-    return img
-
+# Diff and histogram this many channel values at a time. Small enough for
+# the int16 temporary and bincount's index copy to stay in cache.
+BLOCK_VALUES = 1 << 16
 
-def pad_to_same_size(a: Image.Image, b: Image.Image):
-    max_w = max(a.width, b.width)
-    max_h = max(a.height, b.height)
-
-    def pad(img):
-        if img.width == max_w and img.height == max_h:
-            return img
-        canvas = Image.new("RGB", (max_w, max_h), (0, 0, 0))
-        canvas.paste(img, (0, 0))
-        return canvas
-
-    return pad(a), pad(b)
+# diff/.cache.json remembers each pair's input digests and result so a
+# re-run skips pairs whose screenshots have not changed. Bump the version
+# whenever the way rms is computed changes, or when older caches may hold
+# wrong results (version 1 could record rms from stale .npy sidecars).
+CACHE_NAME = ".cache.json"
+CACHE_VERSION = 2
+
+# Per-worker diff buffer, sized once for the largest (padded) pair and
+# reused for every pair that worker handles, plus (when cores would
+# otherwise sit idle) a thread for decoding the second image of a pair.
+# See init_worker().
+_diff_buf = None
+_decode_pool = None
+_cache_npy = False
+
+
+def map_file(path: Path) -> mmap.mmap:
+    """Read-only memory map of a file, paged in by the OS on demand."""
+    with path.open("rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def load_image(path: Path) -> np.ndarray:
+    """Decode a screenshot into a contiguous (H, W, 3) uint8 RGB array."""
+    with map_file(path) as mm, Image.open(mm) as img:
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        return np.asarray(img)
+
+
+def header_size(path: Path):
+    """(width, height) read from the PNG header, without decoding pixels."""
+    with Image.open(path) as img:
+        return img.size
+
+
+def load_image_cached(path: Path, digest: str) -> np.ndarray:
+    """load_image through a .npy sidecar, decoding the PNG at most once.
+
+    The sidecar is named after the PNG's content digest (NN-name.<digest>.npy),
+    so a replaced screenshot never picks up old pixels, whatever its mtime.
+    It is memory-mapped read-only, so only the pages the diff touches are
+    read.
+    """
+    npy_path = path.with_name(f"{path.stem}.{digest}.npy")
+    try:
+        arr = np.load(npy_path, mmap_mode="r")
+        if arr.dtype == np.uint8 and arr.ndim == 3 and arr.shape[2] == 3:
+            return arr
+    except (OSError, ValueError):
+        pass
+
+    # Drop sidecars left behind by earlier contents of this screenshot.
+    for old in path.parent.glob(f"{path.stem}.*.npy"):
+        old_digest = old.name[len(path.stem) + 1 : -len(".npy")]
+        if len(old_digest) == len(digest) and all(
+            c in "0123456789abcdef" for c in old_digest
+        ):
+            old.unlink(missing_ok=True)
+    path.with_suffix(".npy").unlink(missing_ok=True)
+
+    arr = load_image(path)
+    np.save(npy_path, arr)
+    return arr
+
+
+def file_digest(path: Path) -> str:
+    """Fingerprint a file's raw bytes without decoding it."""
+    with map_file(path) as mm:
+        return hashlib.blake2b(mm, digest_size=16).hexdigest()
+
+
+def image_size(arr: np.ndarray):
+    """(width, height) of a decoded image, matching PIL's Image.size."""
+    return arr.shape[1], arr.shape[0]
+
+
+def block_rows(arr: np.ndarray) -> int:
+    """Rows per block so one block holds about BLOCK_VALUES channel values."""
+    return max(1, BLOCK_VALUES // (arr.shape[1] * arr.shape[2]))
+
+
+def sum_of_squares(diff: np.ndarray) -> int:
+    """Sum of squared values of a uint8 abs-diff.
+
+    The diff only takes 256 values, so the squares come from a 256-bin
+    histogram instead of squaring every element.
+    """
+    hist = np.zeros(256, dtype=np.int64)
+    step = block_rows(diff)
+    for y in range(0, diff.shape[0], step):
+        hist += np.bincount(diff[y : y + step].ravel(), minlength=256)
+    return int((hist * SQ).sum())
+
+
+def diff_and_ss(a: np.ndarray, b: np.ndarray, out: np.ndarray) -> int:
+    """Write |a - b| into out and return the sum of squared differences.
+
+    Each block of rows is diffed and tallied into the histogram while it
+    is still in cache, rather than diffing the whole image and then
+    reading it back.
+    """
+    hist = np.zeros(256, dtype=np.int64)
+    step = block_rows(out)
+    for y in range(0, out.shape[0], step):
+        block = out[y : y + step]
+        np.abs(
+            np.subtract(a[y : y + step], b[y : y + step], dtype=np.int16),
+            out=block,
+            casting="unsafe",
+        )
+        hist += np.bincount(block.ravel(), minlength=256)
+    return int((hist * SQ).sum())
+
+
+def diff_and_ss_padded(a: np.ndarray, b: np.ndarray, out: np.ndarray) -> int:
+    """diff_and_ss for images of different sizes.
+
+    Gives the same result as padding both with black to out's shape, but
+    only the overlapping region is subtracted. Outside it, each image is
+    diffed against black, so its pixels are copied into out as-is.
+    """
+    h = min(a.shape[0], b.shape[0])
+    w = min(a.shape[1], b.shape[1])
+    out.fill(0)
+    out[: a.shape[0], : a.shape[1]] = a
+    out[: b.shape[0], : b.shape[1]] = b
+    np.abs(
+        np.subtract(a[:h, :w], b[:h, :w], dtype=np.int16),
+        out=out[:h, :w],
+        casting="unsafe",
+    )
+    return sum_of_squares(out)
+
+
+def load_cache(diff_dir: Path) -> dict:
+    """Per-pair cache entries from a previous run, or {} if unusable."""
+    try:
+        data = json.loads((diff_dir / CACHE_NAME).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get("version") != CACHE_VERSION:
+        return {}
+    pairs = data.get("pairs")
+    return pairs if isinstance(pairs, dict) else {}
+
+
+def cache_hit(cached, entry: dict) -> bool:
+    """Whether a cached entry is well-formed and has the same input digests."""
+    return (
+        isinstance(cached, dict)
+        and cached.get("explore") == entry["explore"]
+        and cached.get("script") == entry["script"]
+        and isinstance(cached.get("rms"), (int, float))
+        and isinstance(cached.get("size_note"), str)
+    )
+
+
+def save_cache(diff_dir: Path, entries: dict):
+    data = {"version": CACHE_VERSION, "pairs": entries}
+    (diff_dir / CACHE_NAME).write_text(
+        json.dumps(data, indent=2, sort_keys=True), encoding="utf-8"
+    )
 
 
 def build_pairs(run_dir: Path):
@@ -76,9 +237,172 @@ def build_pairs(run_dir: Path):
     return pairs
 
 
+def init_worker(max_values: int, cache_npy: bool, decode_thread: bool):
+    """Pool initializer: allocate this worker's diff buffer and decode thread."""
+    global _diff_buf, _decode_pool, _cache_npy
+    _diff_buf = np.empty(max_values, dtype=np.uint8)
+    _decode_pool = ThreadPoolExecutor(max_workers=1) if decode_thread else None
+    _cache_npy = cache_npy
+
+
+def process_pair(args):
+    """Diff one explore/script pair and write its diff image.
+
+    cached is this pair's entry from the previous run's cache, if any.
+    Returns (key, rms, size_note, entry); size_note is empty when sizes
+    match and entry is the cache record for this run.
+    """
+    key, explore_path, script_path, diff_dir, cached = args
+    diff_path = diff_dir / f"{key}.png"
+
+    entry = {"explore": file_digest(explore_path), "script": file_digest(script_path)}
+
+    # Unchanged inputs: reuse the previous result, as long as its diff
+    # image (if one was written) is still there.
+    if cache_hit(cached, entry) and (
+        cached["rms"] < MATCH_THRESHOLD or diff_path.exists()
+    ):
+        if cached["rms"] < MATCH_THRESHOLD:
+            # Caches from before matches stopped writing a diff image may
+            # still have one on disk.
+            diff_path.unlink(missing_ok=True)
+        return key, float(cached["rms"]), cached["size_note"], cached
+
+    # Byte-identical screenshots diff to all black; skip both decodes.
+    # Like any match, no diff image is written (see below).
+    if entry["explore"] == entry["script"]:
+        diff_path.unlink(missing_ok=True)
+        entry.update(rms=0.0, size_note="")
+        return key, 0.0, "", entry
+
+    # PIL releases the GIL while inflating PNG data, so if there is a side
+    # thread, decode the script image there while this one decodes the
+    # explore image.
+    def load(path, digest):
+        return load_image_cached(path, digest) if _cache_npy else load_image(path)
+
+    if _decode_pool is not None:
+        script_future = _decode_pool.submit(load, script_path, entry["script"])
+        a = load(explore_path, entry["explore"])
+        b = script_future.result()
+    else:
+        a = load(explore_path, entry["explore"])
+        b = load(script_path, entry["script"])
+
+    # Diff into a contiguous prefix of the worker's buffer rather than a
+    # fresh allocation.
+    size_note = ""
+    if a.shape == b.shape:
+        diff_arr = _diff_buf[: a.size].reshape(a.shape)
+        ss = diff_and_ss(a, b, diff_arr)
+    else:
+        size_note = f"(size mismatch: explore {image_size(a)} vs script {image_size(b)})"
+        shape = (max(a.shape[0], b.shape[0]), max(a.shape[1], b.shape[1]), 3)
+        diff_arr = _diff_buf[: math.prod(shape)].reshape(shape)
+        ss = diff_and_ss_padded(a, b, diff_arr)
+    diff_rms = math.sqrt(ss / diff_arr.size)
+
+    # Matches are rendering noise nobody needs to open, so skip the PNG
+    # encode and drop any stale diff instead. Diffs are mostly black, so
+    # fast zlib level 1 still compresses well.
+    if diff_rms < MATCH_THRESHOLD:
+        diff_path.unlink(missing_ok=True)
+    else:
+        Image.fromarray(diff_arr).save(diff_path, format="PNG", compress_level=1)
+
+    entry.update(rms=diff_rms, size_note=size_note)
+    return key, diff_rms, size_note, entry
+
+
+def verdict(diff_rms: float) -> str:
+    if diff_rms < MATCH_THRESHOLD:
+        return "MATCH (rendering noise)"
+    if diff_rms < REVIEW_THRESHOLD:
+        return "REVIEW (possible change)"
+    return "DIFFERS (different content)"
+
+
+def pair_section(key: str, diff_rms: float, size_note: str) -> str:
+    if diff_rms == 0:
+        diff_line = "- diff: identical (not written)"
+    elif diff_rms < MATCH_THRESHOLD:
+        diff_line = "- diff: skipped (match)"
+    else:
+        diff_line = f"- diff: `diff/{key}.png`"
+    rms_line = f"- rms: **{diff_rms:.2f}** {size_note}".rstrip()
+    return (
+        f"## {key} — {verdict(diff_rms)}\n"
+        "\n"
+        f"- explore: `explore/{key}.png`\n"
+        f"- script: `script/{key}.png`\n"
+        f"{diff_line}\n"
+        f"{rms_line}\n"
+        "\n"
+    )
+
+
+def write_report(report_path: Path, run_name: str, results):
+    """Stream report.md section by section instead of joining one big list."""
+    matches = [(k, r) for k, r, _ in results if r < MATCH_THRESHOLD]
+    minor_diffs = [(k, r) for k, r, _ in results if MATCH_THRESHOLD <= r < REVIEW_THRESHOLD]
+    major_diffs = [(k, r) for k, r, _ in results if r >= REVIEW_THRESHOLD]
+    total = len(results)
+
+    with report_path.open("w", encoding="utf-8", buffering=1 << 20) as f:
+        f.write(f"# Screenshot Diff Report\n\nRun: `{run_name}`\n\n")
+        f.writelines(pair_section(*result) for result in results)
+
+        # --- Recommendation ---
+        f.write("---\n\n# Recommendation\n\n")
+        f.write(f"**{len(matches)}/{total}** steps match, "
+                f"**{len(minor_diffs)}** minor diffs, "
+                f"**{len(major_diffs)}** major diffs.\n\n")
+
+        if not major_diffs and not minor_diffs:
+            f.write("**Verdict: ALL CLEAR** — Explore and script paths "
+                    "are visually identical. No action needed.\n")
+        elif major_diffs:
+            f.write("**Verdict: SCRIPTS NEED UPDATE** — The explore path "
+                    "(live app) shows a different flow than the scripted tests.\n\n")
+            f.write("### Divergence point\n\n")
+            first_major = major_diffs[0]
+            f.write(f"The first major divergence is at step **{first_major[0]}** "
+                    f"(rms: {first_major[1]:.2f}).\n\n")
+            f.write("This means the live app has changed in a way the scripts "
+                    "don't account for. The explore path succeeded through the "
+                    "full flow, so the app itself is working correctly.\n\n")
+            f.write("### Steps that diverge\n\n")
+            f.writelines(f"- **{k}** — rms: {r:.2f}\n" for k, r in major_diffs)
+            f.write("\n### Action items\n\n")
+            f.write("1. Review the diff images side-by-side to confirm the "
+                    "explore path represents the correct behavior.\n")
+            f.write("2. If explore is correct: **update the Playwright scripts** "
+                    "to match the new flow.\n")
+            f.write("3. If explore found a bug: **fix the app**, then re-run "
+                    "both paths to confirm scripts pass.\n")
+        elif minor_diffs:
+            f.write("**Verdict: REVIEW NEEDED** — Minor visual differences detected. "
+                    "These may be timing artifacts, animation states, or subtle "
+                    "layout shifts.\n\n")
+            f.writelines(f"- **{k}** — rms: {r:.2f}\n" for k, r in minor_diffs)
+            f.write("\nReview the diff images to determine if these are "
+                    "cosmetic (ignore) or functional (fix scripts/app).\n")
+
+
 def main():
-    if len(sys.argv) > 1:
-        run_dir = Path(sys.argv[1])
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("run_folder", nargs="?", type=Path)
+    parser.add_argument(
+        "--cache-npy",
+        action="store_true",
+        help="cache decoded pixels as .npy next to each screenshot",
+    )
+    args = parser.parse_args()
+
+    if args.run_folder:
+        run_dir = args.run_folder
     else:
         # Use the latest timestamped folder in screenshots/
         candidates = sorted(
@@ -98,108 +422,44 @@ def main():
     if not pairs:
         raise SystemExit(f"No explore/script screenshot pairs found in {run_dir}")
 
-    report_lines = ["# Screenshot Diff Report", "", f"Run: `{run_dir.name}`", ""]
-
-    results = []  # (key, rms, size_mismatch)
-
-    for key, items in sorted(pairs.items()):
-        explore_path = items.get("explore")
-        script_path = items.get("script")
-        if not explore_path or not script_path:
-            continue
-
-        explore_img = load_image(explore_path)
-        script_img = load_image(script_path)
-
-        size_note = ""
-        size_mismatch = explore_img.size != script_img.size
-        if size_mismatch:
-            size_note = f"(size mismatch: explore {explore_img.size} vs script {script_img.size})"
-            explore_img, script_img = pad_to_same_size(explore_img, script_img)
-
-        diff = ImageChops.difference(explore_img, script_img)
-        stat = ImageStat.Stat(diff)
-        diff_rms = rms(stat.rms)
-
-        diff_path = diff_dir / f"{key}.png"
-        diff.save(diff_path)
-
-        results.append((key, diff_rms, size_mismatch))
-
-        if diff_rms < MATCH_THRESHOLD:
-            verdict = "MATCH (rendering noise)"
-        elif diff_rms < REVIEW_THRESHOLD:
-            verdict = "REVIEW (possible change)"
-        else:
-            verdict = "DIFFERS (different content)"
-        report_lines.append(f"## {key} — {verdict}")
-        report_lines.append("")
-        report_lines.append(f"- explore: `explore/{key}.png`")
-        report_lines.append(f"- script: `script/{key}.png`")
-        report_lines.append(f"- diff: `diff/{key}.png`")
-        report_lines.append(f"- rms: **{diff_rms:.2f}** {size_note}".rstrip())
-        report_lines.append("")
-
-    # --- Recommendation ---
-    matches = [(k, r) for k, r, _ in results if r < MATCH_THRESHOLD]
-    minor_diffs = [(k, r) for k, r, _ in results if MATCH_THRESHOLD <= r < REVIEW_THRESHOLD]
-    major_diffs = [(k, r) for k, r, _ in results if r >= REVIEW_THRESHOLD]
-    total = len(results)
-
-    report_lines.append("---")
-    report_lines.append("")
-    report_lines.append("# Recommendation")
-    report_lines.append("")
-    report_lines.append(f"**{len(matches)}/{total}** steps match, "
-                        f"**{len(minor_diffs)}** minor diffs, "
-                        f"**{len(major_diffs)}** major diffs.")
-    report_lines.append("")
-
-    if not major_diffs and not minor_diffs:
-        report_lines.append("**Verdict: ALL CLEAR** — Explore and script paths "
-                            "are visually identical. No action needed.")
-    elif major_diffs:
-        report_lines.append("**Verdict: SCRIPTS NEED UPDATE** — The explore path "
-                            "(live app) shows a different flow than the scripted tests.")
-        report_lines.append("")
-        report_lines.append("### Divergence point")
-        report_lines.append("")
-        first_major = major_diffs[0]
-        report_lines.append(f"The first major divergence is at step **{first_major[0]}** "
-                            f"(rms: {first_major[1]:.2f}).")
-        report_lines.append("")
-        report_lines.append("This means the live app has changed in a way the scripts "
-                            "don't account for. The explore path succeeded through the "
-                            "full flow, so the app itself is working correctly.")
-        report_lines.append("")
-        report_lines.append("### Steps that diverge")
-        report_lines.append("")
-        for k, r in major_diffs:
-            report_lines.append(f"- **{k}** — rms: {r:.2f}")
-        report_lines.append("")
-        report_lines.append("### Action items")
-        report_lines.append("")
-        report_lines.append("1. Review the diff images side-by-side to confirm the "
-                            "explore path represents the correct behavior.")
-        report_lines.append("2. If explore is correct: **update the Playwright scripts** "
-                            "to match the new flow.")
-        report_lines.append("3. If explore found a bug: **fix the app**, then re-run "
-                            "both paths to confirm scripts pass.")
-    elif minor_diffs:
-        report_lines.append("**Verdict: REVIEW NEEDED** — Minor visual differences detected. "
-                            "These may be timing artifacts, animation states, or subtle "
-                            "layout shifts.")
-        report_lines.append("")
-        for k, r in minor_diffs:
-            report_lines.append(f"- **{k}** — rms: {r:.2f}")
-        report_lines.append("")
-        report_lines.append("Review the diff images to determine if these are "
-                            "cosmetic (ignore) or functional (fix scripts/app).")
-
-    report_lines.append("")
+    cache = load_cache(diff_dir)
+    tasks = [
+        (key, items["explore"], items["script"], diff_dir, cache.get(key))
+        for key, items in pairs.items()
+        if items.get("explore") and items.get("script")
+    ]
+
+    # Size each worker's diff buffer for the largest padded pair, using
+    # PNG headers only.
+    max_values = 0
+    for _, explore_path, script_path, _, _ in tasks:
+        (ew, eh), (sw, sh) = header_size(explore_path), header_size(script_path)
+        max_values = max(max_values, max(ew, sw) * max(eh, sh) * 3)
+
+    # Pairs are independent and PNG decode/encode dominates, so fan them
+    # out across processes and restore filename order afterwards. A run
+    # has one pair per step, so hand out one pair at a time and don't
+    # start workers that would sit idle.
+    # With fewer pairs than cores, give each worker a second decode thread
+    # to use the spare cores; otherwise the workers already fill them.
+    cpus = os.cpu_count() or 1
+    results = []  # (key, rms, size_note)
+    new_cache = {}
+    with Pool(
+        processes=max(1, min(cpus, len(tasks))),
+        initializer=init_worker,
+        initargs=(max_values, args.cache_npy, len(tasks) < cpus),
+    ) as pool:
+        for key, diff_rms, size_note, entry in pool.imap_unordered(
+            process_pair, tasks, chunksize=1
+        ):
+            results.append((key, diff_rms, size_note))
+            new_cache[key] = entry
+    results.sort()
+    save_cache(diff_dir, new_cache)
 
     report_path = run_dir / "report.md"
-    report_path.write_text("\n".join(report_lines), encoding="utf-8")
+    write_report(report_path, run_dir.name, results)
 
     print(f"Wrote {report_path}")
 